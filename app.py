@@ -1,47 +1,136 @@
-from flask import Flask, render_template, Response, jsonify
+from flask import Flask, render_template, Response, request
+import orjson
 import time
 import threading
-from datetime import datetime, timedelta
+import queue
+import atexit
+import multiprocessing
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 # Importar nuestros módulos personalizados
 import database
 from camera import Camera
 import gemini_client
-import arduino_serial
+import arduino_worker
 
 app = Flask(__name__)
-database.init_db()
-arduino_serial.init_serial()
 
 # --- Configuración de Sensibilidad ---
 # Puedes ajustar estos valores sin tocar camera.py
-FRAME_DELTA_THRESHOLD = 30      # Umbral para detectar un objeto (vs. fondo). Más bajo = más sensible.
+FRAME_DELTA_THRESHOLD = 30      # Diferencia de intensidad (0-255) para detectar un objeto (vs. fondo). Más bajo = más sensible.
 MIN_CONTOUR_AREA = 500          # Área mínima en píxeles para considerar un objeto.
 
 # --- Nueva Configuración de Estabilidad ---
 STABILITY_PIXEL_THRESHOLD = 1500 # Umbral de cambio de píxeles para detectar MOVIMIENTO. Más bajo = más sensible.
 STABILITY_DURATION_SEC = 3.0     # Segundos que el objeto debe estar quieto para ser clasificado.
+STABILITY_TIMEOUT_SEC = 3.0      # Segundos máximos esperando a que el objeto se estabilice.
+COOLDOWN_SEC = 10.0              # Segundos de enfriamiento tras una clasificación.
+
+ARDUINO_ACK_TIMEOUT_SEC = 5.0   # Segundos máximos esperando la confirmación del proceso del Arduino.
+ARDUINO_STOP_TIMEOUT_SEC = 3.0  # Segundos máximos esperando a que el proceso del Arduino cierre el puerto al salir.
+GEMINI_WAIT_TIMEOUT_SEC = 120.0 # Segundos máximos en ESPERANDO_GEMINI antes de volver a esperar objetos.
 
-try:
-    cam = Camera(
-        frame_delta_thresh=FRAME_DELTA_THRESHOLD,
-        min_contour_area=MIN_CONTOUR_AREA,
-        stability_pixel_threshold=STABILITY_PIXEL_THRESHOLD,
-        stability_duration_sec=STABILITY_DURATION_SEC
-    )
-except RuntimeError as e:
-    print(f"Error crítico al iniciar la cámara: {e}")
-    cam = None
+# La base de datos, la cámara y el proceso del Arduino se inician en __main__ para que el
+# proceso hijo (que re-importa este módulo en Windows) no abra la cámara ni la base de datos.
+cam = None
+
+# --- Proceso dedicado para la comunicación serial ---
+arduino_cmd_q = None
+arduino_ack_q = None
+arduino_process = None
+# Número de secuencia de cada comando; el proceso lo devuelve con la confirmación
+_arduino_seq = itertools.count()
 
 # --- Máquina de Estados para el Control Automático ---
 system_state = "ESPERANDO_OBJETO"
-last_state_change = datetime.now()
+last_state_change = time.monotonic()
 is_classifying = threading.Lock()
+# Identifica la clasificación en curso. El timeout de ESPERANDO_GEMINI lo incrementa, de modo
+# que una respuesta que llegue tarde se reconoce como obsoleta y no mueve el Arduino.
+classification_id = 0
+
+# --- Cola de Mensajes para la Voz del Navegador ---
+# deque tiene append/popleft atómicos en CPython, así que no necesita un Lock
+# maxlen descarta los mensajes más viejos si la interfaz deja de consultarlos
+MESSAGES_TO_SPEAK = collections.deque(maxlen=32)
+SPEECH_DEDUP_SEC = 2.0  # Un mensaje idéntico dentro de este intervalo no se repite
+_last_spoken = {}
+
+# --- Caché de /history ---
+# (versión del historial, ETag, cuerpo JSON). Se reemplaza la tupla completa para que
+# los hilos del servidor siempre vean un estado consistente.
+_HISTORY_BOOT_ID = f"{int(time.time()):x}"
+_history_cache = (-1, '', b'[]')
+
+# Ejecutor para solapar la escritura en la base de datos con el envío al Arduino
+io_executor = ThreadPoolExecutor(max_workers=2)
+
+
+def fast_json(obj):
+    """Serializa con orjson, bastante más rápido que jsonify para listas de diccionarios."""
+    return Response(orjson.dumps(obj), mimetype='application/json')
+
+
+def start_arduino_worker():
+    """Lanza el proceso que es dueño del puerto serial del Arduino."""
+    global arduino_cmd_q, arduino_ack_q, arduino_process
+    arduino_cmd_q = multiprocessing.Queue()
+    arduino_ack_q = multiprocessing.Queue()
+    arduino_process = multiprocessing.Process(target=arduino_worker.run, args=(arduino_cmd_q, arduino_ack_q), daemon=True)
+    arduino_process.start()
+    atexit.register(stop_arduino_worker)
+
+
+def stop_arduino_worker():
+    """Pide al proceso del Arduino que cierre el puerto serial y espera a que termine."""
+    if arduino_process is None or not arduino_process.is_alive():
+        return
+    arduino_cmd_q.put(None)
+    # Sin esperar aquí, el manejador de salida de multiprocessing (que corre después de
+    # este) terminaría al proceso daemon antes de que leyera el None y cerrara el puerto
+    arduino_process.join(ARDUINO_STOP_TIMEOUT_SEC)
+    if arduino_process.is_alive():
+        print("Aviso: El proceso del Arduino no terminó a tiempo.")
+
+
+def add_speech_message(message):
+    """Encola un mensaje para que la interfaz web lo lea en voz alta."""
+    if not message:
+        return
+    now = time.monotonic()
+    if message == _last_spoken.get('msg') and now - _last_spoken.get('t', 0) < SPEECH_DEDUP_SEC:
+        return
+    _last_spoken['msg'] = message
+    _last_spoken['t'] = now
+    MESSAGES_TO_SPEAK.append(message)
+
+
+def send_to_arduino(material):
+    """Envía el material al proceso del Arduino y espera su confirmación."""
+    if arduino_cmd_q is None:
+        print("Error: El proceso del Arduino no está iniciado.")
+        return False
+
+    seq = next(_arduino_seq)
+    arduino_cmd_q.put((seq, material))
+    deadline = time.monotonic() + ARDUINO_ACK_TIMEOUT_SEC
+    while True:
+        try:
+            ack_seq, ok = arduino_ack_q.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            print("Error: El proceso del Arduino no respondió a tiempo.")
+            return False
+        if ack_seq == seq:
+            return ok
+        # Confirmación tardía de un comando anterior que ya había expirado
+        print(f"Descartando confirmación atrasada del comando {ack_seq}.")
 
 
 def classify_and_process():
-    """Función central que captura, clasifica y envía a Arduino."""
-    global system_state, last_state_change
+    """Captura un fotograma y lo envía a Gemini sin bloquear la máquina de estados."""
+    global system_state, last_state_change, classification_id
 
     if not is_classifying.acquire(blocking=False):
         return {"error": "Clasificación ya en progreso."}, 429
@@ -50,30 +139,70 @@ def classify_and_process():
     try:
         frame_to_classify = cam.get_frame_bytes()
         if not frame_to_classify:
+            is_classifying.release()
             return {"error": "No se pudo capturar imagen para clasificar."}, 500
 
         print("1. Enviando imagen a Gemini...")
-        gemini_result = gemini_client.classify_image(frame_to_classify)
+        system_state = "ESPERANDO_GEMINI"
+        last_state_change = time.monotonic()
+        classification_id += 1
+        current_id = classification_id
+        # La codificación y la llamada de red corren en el pool de gemini_client,
+        # así la máquina de estados sigue respondiendo
+        future = gemini_client.submit_classification(frame_to_classify)
+    except Exception:
+        is_classifying.release()
+        raise
+
+    # El lock se libera en _on_gemini_done cuando termine la clasificación
+    future.add_done_callback(lambda f: _on_gemini_done(f, current_id))
+    return {"status": "submitted"}, 202
+
+
+def _on_gemini_done(future, request_id):
+    """Procesa la respuesta de Gemini: guarda el registro y envía el material al Arduino."""
+    global system_state, last_state_change
+
+    try:
+        try:
+            gemini_result = future.result()
+        except Exception as e:
+            print(f"Error inesperado durante la clasificación: {e}")
+            gemini_result = None
+
+        if request_id != classification_id:
+            # La espera ya expiró: el objeto pudo retirarse o cambiarse, así que no se actúa
+            print("Respuesta de Gemini descartada: llegó después del tiempo de espera.")
+            return
+
         if not gemini_result or "material" not in gemini_result:
-            return {"error": "La clasificación de Gemini falló."}, 500
+            print("La clasificación de Gemini falló.")
+            system_state = "ESPERANDO_OBJETO"
+            last_state_change = time.monotonic()
+            return
 
         material = gemini_result.get("material")
         objetos = gemini_result.get("objeto_s", [])
         confianza = objetos[0].get('confianza', 0.0) if objetos else 0.0
 
         print(f"2. Resultado de Gemini: {material}")
-        record_id = database.add_record(material, objetos, confianza, 'PENDIENTE')
+        add_speech_message(gemini_result.get("respuesta_hablada"))
+        # El registro en la base de datos y el envío al Arduino se hacen en paralelo
+        fut_db = io_executor.submit(database.add_record, material, objetos, confianza, 'PENDIENTE')
 
         estado_final = 'NO_ENVIADO'
         if material and material != "null":
             print("3. Enviando comando al Arduino...")
-            if arduino_serial.send_command(material):
+            fut_arduino = io_executor.submit(send_to_arduino, material)
+            record_id = fut_db.result()
+            if fut_arduino.result():
                 estado_final = 'ENVIADO'
                 print("4. Arduino confirmó la recepción.")
             else:
                 estado_final = 'ERROR_ARDUINO'
                 print("4. ERROR: Arduino no confirmó.")
         else:
+            record_id = fut_db.result()
             estado_final = 'NO_REQUERIDO'
 
         database.update_record_status(record_id, estado_final)
@@ -81,41 +210,53 @@ def classify_and_process():
 
         # Iniciar enfriamiento para no reclasificar inmediatamente
         system_state = "EN_ENFRIAMIENTO"
-        last_state_change = datetime.now()
-        print(f"Sistema en ENFRIAMIENTO por 3 segundos.")
+        last_state_change = time.monotonic()
+        print(f"Sistema en ENFRIAMIENTO por {COOLDOWN_SEC:g} segundos.")
 
-        return {"status": "success", "classification": gemini_result}, 200
+    except Exception as e:
+        # Las excepciones de un callback de Future se pierden en silencio: se registran aquí
+        print(f"Error al procesar la respuesta de Gemini: {e}")
 
     finally:
+        # Cualquier salida que no haya cambiado el estado (ej. una excepción) no debe dejar
+        # la máquina de estados bloqueada en ESPERANDO_GEMINI
+        if request_id == classification_id and system_state == "ESPERANDO_GEMINI":
+            system_state = "ESPERANDO_OBJETO"
+            last_state_change = time.monotonic()
         is_classifying.release()
 
 
 def automatic_classification_thread():
     """Hilo en segundo plano que opera la máquina de estados."""
-    global system_state, last_state_change
+    global system_state, last_state_change, classification_id
     print("Iniciando hilo de clasificación automática...")
 
     while True:
-        time.sleep(0.2)  # Pequeña pausa para no sobrecargar el CPU
-        if not cam: continue
+        if not cam:
+            time.sleep(1.0)
+            continue
+
+        # Esperar a que la cámara procese un fotograma nuevo en lugar de sondear
+        if not cam.frame_ready.wait(timeout=1.0):
+            continue
+        cam.frame_ready.clear()
 
         # --- Lógica de la Máquina de Estados ---
 
         if system_state == "ESPERANDO_OBJETO":
             if cam.detect_object_presence():
                 system_state = "ESPERANDO_ESTABILIDAD"
-                last_state_change = datetime.now()
+                last_state_change = time.monotonic()
                 print("Estado -> ESPERANDO_ESTABILIDAD (Objeto detectado)")
 
         elif system_state == "ESPERANDO_ESTABILIDAD":
             # Si el objeto se queda quieto, clasifícalo
             if cam.is_object_stable():
                 print("Objeto ESTABLE. Iniciando clasificación...")
-                with app.app_context():
-                    classify_and_process()
+                classify_and_process()
 
-            # Timeout: si el objeto se mueve por más de 10s, vuelve a esperar
-            elif (datetime.now() - last_state_change).total_seconds() > 3:
+            # Timeout: si el objeto se mueve demasiado tiempo, vuelve a esperar
+            elif (time.monotonic() - last_state_change) > STABILITY_TIMEOUT_SEC:
                 print("Timeout de estabilidad. Objeto se movió demasiado tiempo.")
                 system_state = "ESPERANDO_OBJETO"
 
@@ -124,9 +265,19 @@ def automatic_classification_thread():
                 print("El objeto fue removido antes de estabilizarse.")
                 system_state = "ESPERANDO_OBJETO"
 
+        elif system_state == "ESPERANDO_GEMINI":
+            # La respuesta llega en _on_gemini_done, que cambia el estado. Si tarda demasiado
+            # (reintentos, esperas por 429), se vuelve a esperar objetos y la respuesta se
+            # descartará al llegar; mientras la llamada siga en curso, is_classifying impide lanzar otra.
+            if (time.monotonic() - last_state_change) > GEMINI_WAIT_TIMEOUT_SEC:
+                print("Timeout esperando la respuesta de Gemini.")
+                classification_id += 1  # La respuesta, si llega, ya no es válida
+                system_state = "ESPERANDO_OBJETO"
+                last_state_change = time.monotonic()
+
         elif system_state == "EN_ENFRIAMIENTO":
-            if (datetime.now() - last_state_change).total_seconds() > 10:
-                # Después de 10s, vuelve al estado inicial para el siguiente objeto
+            if (time.monotonic() - last_state_change) > COOLDOWN_SEC:
+                # Tras el enfriamiento, vuelve al estado inicial para el siguiente objeto
                 print("Estado -> ESPERANDO_OBJETO (Enfriamiento finalizado)")
                 system_state = "ESPERANDO_OBJETO"
 
@@ -144,14 +295,63 @@ def video_feed():
 
 @app.route('/history')
 def history():
-    return jsonify(database.get_history())
+    global _history_cache
+    version = database.get_history_version()
+    cached_version, etag, body = _history_cache
+
+    if version != cached_version:
+        etag = f'"{_HISTORY_BOOT_ID}-{version}"'
+        body = orjson.dumps(database.get_history())
+        _history_cache = (version, etag, body)
+
+    if request.headers.get('If-None-Match') == etag:
+        return '', 304, {'ETag': etag}
+
+    response = Response(body, mimetype='application/json')
+    response.headers['ETag'] = etag
+    # Obliga al navegador a revalidar con If-None-Match en cada consulta
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/history/<int:record_id>')
+def history_record(record_id):
+    record = database.get_record(record_id)
+    if record is None:
+        return fast_json({"error": "Registro no encontrado."}), 404
+    return fast_json(record)
+
+
+@app.route('/get_messages')
+def get_messages():
+    msgs = []
+    while True:
+        try:
+            msgs.append(MESSAGES_TO_SPEAK.popleft())
+        except IndexError:
+            break
+    return fast_json(msgs)
 
 
 if __name__ == '__main__':
+    database.init_db()
+    start_arduino_worker()
+
+    try:
+        cam = Camera(
+            frame_delta_thresh=FRAME_DELTA_THRESHOLD,
+            min_contour_area=MIN_CONTOUR_AREA,
+            stability_pixel_threshold=STABILITY_PIXEL_THRESHOLD,
+            stability_duration_sec=STABILITY_DURATION_SEC
+        )
+    except RuntimeError as e:
+        print(f"Error crítico al iniciar la cámara: {e}")
+        cam = None
+
     classifier_thread = threading.Thread(target=automatic_classification_thread, daemon=True)
     classifier_thread.start()
-    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
-
-import atexit
 
-atexit.register(arduino_serial.close_serial)
\ No newline at end of file
+    # Servidor WSGI con hilos: /video_feed no bloquea al resto de las rutas.
+    # No usar eventlet/gevent, son incompatibles con el hilo de la cámara.
+    from waitress import serve
+    serve(app, host='0.0.0.0', port=5000, threads=8)
\ No newline at end of file
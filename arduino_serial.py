@@ -8,6 +8,14 @@ import time
 ARDUINO_PORT = 'COM3'
 BAUD_RATE = 9600
 TIMEOUT = 2  # Tiempo máximo de espera para la respuesta del Arduino en segundos
+WRITE_TIMEOUT = 1.0  # Tiempo máximo para escribir un comando, evita bloqueos si el puerto se atasca
+BOOT_TIMEOUT = 2.0  # Tiempo máximo esperando el mensaje "READY" del Arduino al conectar
+
+# Comandos válidos ya codificados, con el salto de línea que usa el Arduino como delimitador
+COMMANDS = {k: (k + '\n').encode('ascii') for k in ('PLASTICO', 'ORGANICO', 'METAL')}
+# Gemini responde con tildes ("plástico", "orgánico")
+COMMANDS['PLÁSTICO'] = COMMANDS['PLASTICO']
+COMMANDS['ORGÁNICO'] = COMMANDS['ORGANICO']
 
 # Variable global para mantener la conexión
 ser = None
@@ -19,8 +27,23 @@ def init_serial():
     """
     global ser
     try:
-        ser = serial.Serial(ARDUINO_PORT, BAUD_RATE, timeout=TIMEOUT)
-        time.sleep(2)  # Esperar a que la conexión se establezca
+        ser = serial.Serial(timeout=TIMEOUT, write_timeout=WRITE_TIMEOUT, exclusive=True)
+        ser.port = ARDUINO_PORT
+        ser.baudrate = BAUD_RATE
+        # Evita (donde el driver lo respeta) que el Arduino se reinicie al abrir el puerto
+        ser.dtr = False
+        ser.open()
+        try:
+            # Reduce el temporizador de latencia del FTDI de 16 ms a 1 ms (solo Linux)
+            ser.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError, ValueError, OSError):
+            pass
+
+        # Esperar a que el Arduino anuncie "READY" en lugar de dormir 2 segundos fijos.
+        # Si el sketch no envía el anuncio, se continúa al vencer BOOT_TIMEOUT.
+        banner = _read_line(time.monotonic() + BOOT_TIMEOUT)
+        if banner != "READY":
+            print("Aviso: El Arduino no envió 'READY', se continúa de todas formas.")
         print(f"Conexión serial establecida en el puerto {ARDUINO_PORT}.")
         return True
     except serial.SerialException as e:
@@ -30,6 +53,28 @@ def init_serial():
         return False
 
 
+def _read_line(deadline):
+    """
+    Lee una línea del Arduino sondeando el buffer en lugar de bloquear en
+    readline(), para ceder el GIL a los demás hilos.
+
+    Args:
+        deadline (float): Instante límite según time.monotonic().
+
+    Returns:
+        str: La línea recibida sin el salto de línea, o '' si no llegó a tiempo.
+    """
+    buf = bytearray()
+    while time.monotonic() < deadline:
+        n = ser.in_waiting
+        if n:
+            buf += ser.read(n)
+            if b'\n' in buf:
+                break
+        time.sleep(0.002)
+    return bytes(buf).split(b'\n', 1)[0].decode('utf-8', errors='replace').strip()
+
+
 def send_command(command):
     """
     Envía un comando al Arduino y espera una confirmación "OK".
@@ -41,6 +86,11 @@ def send_command(command):
         bool: True si el comando se envió y se recibió "OK", False en caso contrario.
     """
     global ser
+    payload = COMMANDS.get(command.upper())
+    if payload is None:
+        print(f"Error: Comando desconocido para el Arduino: '{command}'.")
+        return False
+
     if ser is None or not ser.is_open:
         print("Error: La conexión serial no está disponible.")
         # Intenta reconectar
@@ -51,14 +101,11 @@ def send_command(command):
         # Limpiar el buffer de entrada para descartar datos viejos
         ser.reset_input_buffer()
 
-        # Añadir un salto de línea, que es un delimitador común para Arduino
-        full_command = (command.upper() + '\n').encode('utf-8')
-
-        print(f"Enviando comando a Arduino: {full_command.decode().strip()}")
-        ser.write(full_command)
+        print(f"Enviando comando a Arduino: {payload.decode().strip()}")
+        ser.write(payload)
 
         # Esperar la respuesta del Arduino
-        response = ser.readline().decode('utf-8').strip()
+        response = _read_line(time.monotonic() + TIMEOUT)
 
         print(f"Respuesta de Arduino: '{response}'")
 
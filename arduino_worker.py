@@ -0,0 +1,35 @@
+import arduino_serial
+
+
+def run(cmd_q, ack_q):
+    """
+    Proceso dedicado que es dueño de la conexión serial con el Arduino.
+
+    Lee comandos de `cmd_q`, los envía al Arduino y publica en `ack_q` si
+    se recibió la confirmación "OK", junto con el número de secuencia del comando
+    para que quien espera no lo confunda con la de un comando anterior.
+    Un `None` en la cola detiene el proceso.
+
+    Args:
+        cmd_q (multiprocessing.Queue): Cola de pares (seq, comando) a enviar (ej. (3, "PLASTICO")).
+        ack_q (multiprocessing.Queue): Cola donde se publica (seq, resultado) de cada comando.
+    """
+    arduino_serial.init_serial()
+    try:
+        while True:
+            cmd = cmd_q.get()
+            if cmd is None:
+                break
+            seq, material = cmd
+            try:
+                ok = arduino_serial.send_command(material)
+            except Exception as e:
+                # Un comando inválido (ej. un material que no es texto) no debe matar el proceso:
+                # se reporta como no confirmado y se sigue atendiendo la cola
+                print(f"Error al enviar el comando {material!r} al Arduino: {e}")
+                ok = False
+            ack_q.put((seq, ok))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        arduino_serial.close_serial()
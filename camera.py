@@ -1,7 +1,71 @@
 import cv2
+import numpy as np
+import sys
 import time
 import threading
-from datetime import datetime, timedelta
+
+import utils_numba
+
+# Codificador JPEG opcional (libjpeg-turbo vía PyTurboJPEG), varias veces más rápido que cv2.imencode
+try:
+    from turbojpeg import TurboJPEG
+    _turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbo_jpeg = None
+
+# Activa la Transparent API de OpenCV: con cv2.UMat las operaciones se ejecutan
+# en la GPU integrada mediante OpenCL cuando está disponible
+cv2.ocl.setUseOpenCL(True)
+
+# Fotogramas usados para entrenar el modelo de fondo al (re)capturarlo
+BACKGROUND_WARMUP_FRAMES = 30
+
+# Tasa de aprendizaje del fondo mientras no hay objeto (equivale a history=500). Con un objeto
+# presente el modelo se congela: si siguiera aprendiendo, absorbería el objeto quieto en
+# un par de segundos, antes de que llegue a considerarse estable.
+BACKGROUND_LEARNING_RATE = 1.0 / 500
+
+# Varianza fija por píxel del modelo MOG2. Con la varianza fija, la prueba de MOG2
+# (d² > varThreshold·σ²) equivale a |píxel - fondo| > frame_delta_thresh, el mismo
+# umbral de intensidad 0-255 que usa la detección de movimiento.
+MOG2_PIXEL_VARIANCE = 16.0
+
+# Ranuras del buffer circular de fotogramas. Con 3, la ranura que un lector está
+# codificando no se sobrescribe hasta dos fotogramas después.
+FRAME_RING_SIZE = 3
+
+# Resolución solicitada a la cámara
+CAPTURE_WIDTH = 640
+CAPTURE_HEIGHT = 480
+
+# Calidad JPEG del stream (solo vista previa) y de la imagen que se envía a Gemini
+STREAM_JPEG_QUALITY = 70
+GEMINI_JPEG_QUALITY = 95
+
+# Cabecera de cada parte del stream MJPEG (multipart/x-mixed-replace)
+BOUNDARY_HEAD = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: '
+
+
+def _blur(gray, ksize):
+    """
+    Suavizado previo a la detección. stackBlur (OpenCV >= 4.7) cuesta O(1) por píxel
+    sin importar el tamaño del kernel; si no existe, se usa un boxFilter equivalente.
+    """
+    if hasattr(cv2, 'stackBlur'):
+        return cv2.stackBlur(gray, ksize)
+    return cv2.boxFilter(gray, -1, ksize, borderType=cv2.BORDER_REPLICATE)
+
+
+def _encode_jpeg(img, quality):
+    """Codifica una imagen BGR como JPEG. Devuelve los bytes o None si falla."""
+    if _turbo_jpeg is not None:
+        return _turbo_jpeg.encode(img, quality=quality)
+    # Tablas Huffman fijas y sin modo progresivo: la codificación más rápida
+    ret, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality,
+                                           cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+                                           cv2.IMWRITE_JPEG_PROGRESSIVE, 0])
+    return jpeg.tobytes() if ret else None
+
 
 class Camera:
     """
@@ -13,37 +77,86 @@ class Camera:
                  frame_delta_thresh=30,
                  min_contour_area=2000,
                  stability_pixel_threshold=1000,
-                 stability_duration_sec=1.0):
+                 stability_duration_sec=1.0,
+                 processing_size=(320, 240)):
         """
         Inicializa la cámara y los parámetros de detección.
 
         Args:
-            frame_delta_thresh (int): Umbral para la diferencia de píxeles en la detección de presencia.
+            frame_delta_thresh (int): Umbral de diferencia de intensidad (0-255) respecto al fondo y entre fotogramas.
             min_contour_area (int): Área mínima para que un cambio sea considerado un objeto.
             stability_pixel_threshold (int): Umbral de píxeles para considerar que un objeto se está moviendo.
             stability_duration_sec (float): Segundos que un objeto debe estar quieto para ser estable.
+            processing_size (tuple): Resolución (ancho, alto) a la que se reduce el fotograma para la detección.
+                Las áreas y umbrales de píxeles se dan a resolución completa y se escalan internamente.
         """
-        self.video = cv2.VideoCapture(1)
+        # En Linux se usa V4L2 directamente; en otros sistemas, el backend por defecto
+        backend = cv2.CAP_V4L2 if sys.platform.startswith('linux') else cv2.CAP_ANY
+        self.video = cv2.VideoCapture(1, backend)
         if not self.video.isOpened():
             raise RuntimeError("No se pudo iniciar la cámara.")
+        # Pedir MJPG a la cámara: viaja comprimido por USB y el decodificador de
+        # OpenCV (libjpeg-turbo) es más barato que convertir YUYV en la CPU
+        self.video.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        self.video.set(cv2.CAP_PROP_FRAME_WIDTH, CAPTURE_WIDTH)
+        self.video.set(cv2.CAP_PROP_FRAME_HEIGHT, CAPTURE_HEIGHT)
+        # Un solo fotograma en cola: los fotogramas viejos se verían como "movimiento"
+        self.video.set(cv2.CAP_PROP_BUFFERSIZE, 1)
 
         # Parámetros de sensibilidad
         self.frame_delta_thresh = frame_delta_thresh
         self.min_contour_area = min_contour_area
         self.stability_pixel_threshold = stability_pixel_threshold
-        self.stability_duration = timedelta(seconds=stability_duration_sec)
+        self._stability_secs = float(stability_duration_sec)
+
+        # La detección trabaja sobre una imagen reducida de tamaño fijo. Los factores de
+        # escala dependen de la resolución de la cámara y se calculan con el primer fotograma.
+        self.processing_size = processing_size
+        self._capture_shape = None
+        self._scale_x = self._scale_y = 1.0
+        self._min_contour_area_small = min_contour_area
+        self._stability_pixel_threshold_small = stability_pixel_threshold
+        self._movement_contour_area_small = 50
+        self._blur_ksize = (21, 21)
+        # Sin un dispositivo OpenCL, UMat solo añadiría copias
+        self._use_umat = cv2.ocl.haveOpenCL() and cv2.ocl.useOpenCL()
 
         # Variables de estado (manejadas por el hilo de procesamiento)
         self.latest_frame = None
         self.annotated_frame = None
+        # Último fotograma anotado ya codificado en JPEG, compartido por todos los clientes del stream.
+        # Se codifica bajo demanda y solo cuando _frame_seq avanzó desde la última codificación.
+        self._latest_jpeg = b''
+        self._latest_jpeg_seq = -1
+        self._latest_jpeg_lock = threading.Lock()
         self.object_present = False
         self.object_stable = False
+        # Protege object_present/object_stable/stable_since entre el hilo de procesamiento
+        # y la máquina de estados (is_object_stable lee y resetea en una sola operación)
+        self._state_lock = threading.Lock()
+        # Se activa cada vez que el hilo de procesamiento publica un fotograma nuevo
+        self.frame_ready = threading.Event()
+        # Número de secuencia del último fotograma publicado. Los clientes del stream esperan
+        # en la Condition a que avance (un Event no sirve: un cliente lo limpiaría para todos).
+        self._frame_seq = 0
+        self._frame_cond = threading.Condition()
 
         # Variables internas del hilo
-        self.background = None
+        # Modelo de fondo MOG2: actualización, resta y umbral en una sola pasada de OpenCV
+        self.bg_sub = None
+        # Buffers reutilizados en cada fotograma (se reservan con el primero)
+        self._raw_ring = None      # Fotogramas leídos de la cámara (se anotan en el sitio)
+        self._clean_ring = None    # Copias sin anotaciones para Gemini
+        self._ring_pos = 0
+        # Un rectángulo 5x5 equivale a dos dilataciones 3x3, pero en una sola pasada
+        self._dilate_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
+        self._delta_mov = None
+        self._thresh_mov = None
         self.prev_gray = None
         self.stable_since = None
-        self.last_presence_check = datetime.now()
+
+        # Compilar el filtro de contornos antes de procesar el primer fotograma
+        utils_numba.warmup()
 
         # Iniciar el hilo de procesamiento
         self.processing_thread = threading.Thread(target=self._processing_loop, daemon=True)
@@ -62,72 +175,137 @@ class Camera:
         Hilo principal que procesa continuamente los fotogramas de la cámara.
         """
         while True:
-            success, frame = self.video.read()
+            slot = self._ring_pos = (self._ring_pos + 1) % FRAME_RING_SIZE
+            success, frame = self.video.read(self._raw_ring[slot] if self._raw_ring else None)
             if not success:
                 time.sleep(0.1)
                 continue
 
-            # Guardar el fotograma original para enviarlo a Gemini
-            self.latest_frame = frame.copy()
+            if self._clean_ring is None or self._clean_ring[0].shape != frame.shape:
+                self._raw_ring = [np.empty_like(frame) for _ in range(FRAME_RING_SIZE)]
+                self._clean_ring = [np.empty_like(frame) for _ in range(FRAME_RING_SIZE)]
+                np.copyto(self._raw_ring[slot], frame)
+                frame = self._raw_ring[slot]
 
-            # Pre-procesamiento
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            gray = cv2.GaussianBlur(gray, (21, 21), 0)
+            # Guardar el fotograma original para enviarlo a Gemini, sin reservar memoria nueva.
+            # Se publica cambiando la referencia, que es atómica.
+            clean = self._clean_ring[slot]
+            np.copyto(clean, frame)
+            self.latest_frame = clean
+
+            # Pre-procesamiento (sobre la imagen reducida)
+            gray = self._preprocess(frame)
 
             # --- Detección de Presencia (Contornos Verdes) ---
-            if self.background is not None:
-                frame_delta_presence = cv2.absdiff(self.background, gray)
-                thresh_presence = cv2.threshold(frame_delta_presence, self.frame_delta_thresh, 255, cv2.THRESH_BINARY)[1]
-                thresh_presence = cv2.dilate(thresh_presence, None, iterations=2)
-                contours_presence, _ = cv2.findContours(thresh_presence.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-                found_object = False
-                for c in contours_presence:
-                    if cv2.contourArea(c) > self.min_contour_area:
-                        found_object = True
-                        cv2.drawContours(frame, [c], -1, (0, 255, 0), 2) # Verde
-                self.object_present = found_object
+            bg_sub = self.bg_sub
+            if bg_sub is not None:
+                # Solo se aprende el fondo cuando no hay objeto (estado del fotograma anterior)
+                learning_rate = 0.0 if self.object_present else BACKGROUND_LEARNING_RATE
+                thresh_presence = bg_sub.apply(gray, learningRate=learning_rate)
+                cv2.dilate(thresh_presence, self._dilate_kernel, dst=thresh_presence, iterations=1)
+                contours_presence, _ = cv2.findContours(thresh_presence, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+                # Filtrar y dibujar todos los contornos grandes con una sola llamada a OpenCV
+                large_contours = utils_numba.filter_large(contours_presence, self._min_contour_area_small)
+                if large_contours:
+                    cv2.drawContours(frame, self._to_full_res(large_contours), -1, (0, 255, 0), 2) # Verde
+                with self._state_lock:
+                    self.object_present = bool(large_contours)
 
             # --- Detección de Movimiento y Estabilidad (Contornos Rojos) ---
             if self.prev_gray is not None:
-                frame_delta_movement = cv2.absdiff(self.prev_gray, gray)
-                thresh_movement = cv2.threshold(frame_delta_movement, self.frame_delta_thresh, 255, cv2.THRESH_BINARY)[1]
-                
-                # Dibujar contornos de movimiento si hay un objeto presente
-                if self.object_present:
-                    contours_movement, _ = cv2.findContours(thresh_movement.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                    for c in contours_movement:
-                        if cv2.contourArea(c) > 50: # Umbral pequeño para movimiento
-                             cv2.drawContours(frame, [c], -1, (0, 0, 255), 2) # Rojo
+                if self._delta_mov is None or self._delta_mov.shape != gray.shape:
+                    self._delta_mov = np.empty_like(gray)
+                    self._thresh_mov = np.empty_like(gray)
+                cv2.absdiff(self.prev_gray, gray, dst=self._delta_mov)
+                cv2.threshold(self._delta_mov, self.frame_delta_thresh, 255, cv2.THRESH_BINARY, dst=self._thresh_mov)
+                thresh_movement = self._thresh_mov
+                pixel_change_count = cv2.countNonZero(thresh_movement)
+
+                # Dibujar contornos de movimiento si hay un objeto presente. Si casi no
+                # cambiaron píxeles no puede haber contornos visibles y se omite findContours.
+                if self.object_present and pixel_change_count > self._movement_contour_area_small:
+                    contours_movement, _ = cv2.findContours(thresh_movement, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+                    moving_contours = utils_numba.filter_large(contours_movement, self._movement_contour_area_small)
+                    if moving_contours:
+                        cv2.drawContours(frame, self._to_full_res(moving_contours), -1, (0, 0, 255), 2) # Rojo
 
                 # Lógica de estabilidad
-                pixel_change_count = cv2.countNonZero(thresh_movement)
-                if self.object_present and pixel_change_count < self.stability_pixel_threshold:
-                    if self.stable_since is None:
-                        self.stable_since = datetime.now()
-                    
-                    if datetime.now() - self.stable_since >= self.stability_duration:
-                        self.object_stable = True
-                else:
-                    # Si hay movimiento o no hay objeto, se resetea la estabilidad
-                    self.stable_since = None
-                    self.object_stable = False
+                with self._state_lock:
+                    if self.object_present and pixel_change_count < self._stability_pixel_threshold_small:
+                        if self.stable_since is None:
+                            self.stable_since = time.monotonic()
+
+                        if time.monotonic() - self.stable_since >= self._stability_secs:
+                            self.object_stable = True
+                    else:
+                        # Si hay movimiento o no hay objeto, se resetea la estabilidad
+                        self.stable_since = None
+                        self.object_stable = False
 
             self.prev_gray = gray
             self.annotated_frame = frame
-            time.sleep(1/30) # Limitar a ~30 FPS
+            self.frame_ready.set()
+            with self._frame_cond:
+                self._frame_seq += 1
+                self._frame_cond.notify_all()
+            # Sin pausa fija: video.read() ya se bloquea al ritmo natural de la cámara
+
+    def _configure_scale(self, frame):
+        """Ajusta los umbrales a la relación de áreas entre la captura y la resolución de procesamiento."""
+        h, w = frame.shape[:2]
+        self._capture_shape = (h, w)
+        self._scale_x = w / self.processing_size[0]
+        self._scale_y = h / self.processing_size[1]
+        area_ratio = self._scale_x * self._scale_y
+        self._min_contour_area_small = self.min_contour_area / area_ratio
+        self._stability_pixel_threshold_small = self.stability_pixel_threshold / area_ratio
+        self._movement_contour_area_small = 50 / area_ratio
+        blur_size = max(3, int(21 / self._scale_x) | 1)
+        self._blur_ksize = (blur_size, blur_size)
+
+    def _preprocess(self, frame):
+        """Reduce el fotograma a la resolución de procesamiento, lo convierte a grises y lo suaviza."""
+        if frame.shape[:2] != self._capture_shape:
+            self._configure_scale(frame)
+        src = cv2.UMat(frame) if self._use_umat else frame
+        # Reducir antes de cvtColor: todas las operaciones siguientes mueven menos bytes
+        small = cv2.resize(src, self.processing_size, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        gray = _blur(gray, self._blur_ksize)
+        # Una sola descarga de la GPU: el resto del pipeline trabaja con la imagen pequeña en CPU
+        return gray.get() if self._use_umat else gray
+
+    def _to_full_res(self, contours):
+        """Escala contornos de la imagen reducida a la resolución del fotograma original."""
+        factor = np.array([self._scale_x, self._scale_y])
+        return [(c * factor).astype(np.int32) for c in contours]
+
+    def _create_background_subtractor(self):
+        """Crea el sustractor de fondo MOG2 con la sensibilidad configurada."""
+        # varThreshold es una distancia de Mahalanobis al cuadrado: se traduce el umbral de
+        # intensidad a esa escala usando la varianza fija MOG2_PIXEL_VARIANCE
+        bg_sub = cv2.createBackgroundSubtractorMOG2(
+            history=500, varThreshold=self.frame_delta_thresh ** 2 / MOG2_PIXEL_VARIANCE, detectShadows=False)
+        bg_sub.setVarInit(MOG2_PIXEL_VARIANCE)
+        bg_sub.setVarMin(MOG2_PIXEL_VARIANCE)
+        bg_sub.setVarMax(MOG2_PIXEL_VARIANCE)
+        return bg_sub
 
     def update_background(self):
-        """Captura el fotograma actual y lo establece como el nuevo fondo de referencia."""
+        """Entrena un modelo de fondo nuevo con los fotogramas actuales y lo pone en uso."""
         print("Actualizando fondo de referencia...")
-        # Capturamos un par de fotogramas para asegurar que el fondo es estable
-        for _ in range(5):
+        bg_sub = self._create_background_subtractor()
+        gray = None
+        # Capturamos varios fotogramas para que el modelo aprenda un fondo estable
+        for _ in range(BACKGROUND_WARMUP_FRAMES):
             success, frame = self.video.read()
             if success:
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                self.background = cv2.GaussianBlur(gray, (21, 21), 0)
-            time.sleep(0.1)
-        self.prev_gray = self.background
+                gray = self._preprocess(frame)
+                bg_sub.apply(gray)
+        self.bg_sub = bg_sub
+        if gray is not None:
+            self.prev_gray = gray
         print("Fondo actualizado.")
         return True
 
@@ -135,8 +313,21 @@ class Camera:
         """Obtiene el fotograma ORIGINAL (sin anotaciones) codificado como JPEG."""
         if self.latest_frame is None:
             return None
-        ret, jpeg = cv2.imencode('.jpg', self.latest_frame)
-        return jpeg.tobytes() if ret else None
+        return _encode_jpeg(self.latest_frame, GEMINI_JPEG_QUALITY)
+
+    def get_stream_jpeg(self):
+        """
+        Obtiene el último fotograma ANOTADO codificado como JPEG. Se codifica una sola vez
+        por fotograma nuevo, sin importar cuántos clientes vean el stream, y nunca si nadie lo ve.
+        """
+        with self._latest_jpeg_lock:
+            seq = self._frame_seq
+            if seq != self._latest_jpeg_seq and self.annotated_frame is not None:
+                jpeg = _encode_jpeg(self.annotated_frame, STREAM_JPEG_QUALITY)
+                if jpeg:
+                    self._latest_jpeg = jpeg
+                    self._latest_jpeg_seq = seq
+            return self._latest_jpeg
 
     def detect_object_presence(self):
         """FASE 1: Devuelve si el hilo de procesamiento ha detectado un objeto."""
@@ -144,19 +335,27 @@ class Camera:
 
     def is_object_stable(self):
         """FASE 2: Devuelve si el hilo de procesamiento considera el objeto estable."""
-        if self.object_stable:
-            # Resetear después de confirmar para evitar reclasificaciones múltiples
-            self.object_stable = False
-            self.stable_since = None
-            return True
-        return False
+        with self._state_lock:
+            if self.object_stable:
+                # Resetear después de confirmar para evitar reclasificaciones múltiples
+                self.object_stable = False
+                self.stable_since = None
+                return True
+            return False
 
     def stream_generator(self):
         """Generador para el streaming de video con anotaciones."""
+        last_seq = -1
         while True:
-            if self.annotated_frame is not None:
-                ret, jpeg = cv2.imencode('.jpg', self.annotated_frame)
-                if ret:
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n\r\n')
-            time.sleep(1/30) # Coincidir con la tasa del hilo de procesamiento
+            # Enviar cada fotograma en cuanto existe, sin dormir un periodo fijo
+            with self._frame_cond:
+                # Si la cámara se detiene, tras el timeout se reenvía el último JPEG: escribir en
+                # el socket es lo que permite a waitress notar que el cliente se fue y liberar el hilo
+                self._frame_cond.wait_for(lambda: self._frame_seq != last_seq, timeout=1.0)
+                last_seq = self._frame_seq
+            jpeg = self.get_stream_jpeg()
+            if jpeg:
+                # Se envían las partes por separado para no copiar el fotograma completo
+                yield BOUNDARY_HEAD + str(len(jpeg)).encode() + b'\r\n\r\n'
+                yield jpeg
+                yield b'\r\n'
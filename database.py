@@ -1,38 +1,93 @@
 import sqlite3
-import json
-from datetime import datetime
+import threading
+
+import orjson
 
 # Nombre del archivo de la base de datos
 DATABASE_NAME = 'historial.db'
 
+# Una sola conexión persistente compartida por todos los hilos, protegida por _lock,
+# en lugar de abrir y cerrar el archivo en cada consulta
+_conn = None
+_lock = threading.Lock()
+
+# Sentencias fijas: con la conexión persistente, SQLite reutiliza su plan compilado
+# desde la caché de sentencias en lugar de volver a analizar el SQL en cada llamada.
+# La fecha la calcula SQLite en hora local, igual que datetime.now().
+_INSERT_SQL = '''
+    INSERT INTO historial (fecha, material, objetos_detectados, confianza, estado_envio)
+    VALUES (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime'), ?, ?, ?, ?)
+'''
+_UPDATE_SQL = 'UPDATE historial SET estado_envio = ? WHERE id = ?'
+# El historial solo trae el nombre del objeto principal, no el JSON completo de objetos
+_HISTORY_SQL = '''
+    SELECT id, fecha, material, confianza, estado_envio,
+           json_extract(objetos_detectados, '$[0].nombre') AS objeto_principal
+    FROM historial ORDER BY id DESC LIMIT ?
+'''
+_RECORD_SQL = 'SELECT * FROM historial WHERE id = ?'
+
+# Se incrementa con cada escritura para que app.py sepa cuándo cambió el historial
+_history_version = 0
+
+
+def _get_conn():
+    """
+    Devuelve la conexión SQLite compartida, creándola la primera vez.
+    Debe llamarse con _lock adquirido.
+    """
+    global _conn
+    if _conn is None:
+        # isolation_level=None: modo autocommit, cada sentencia es su propia transacción
+        _conn = sqlite3.connect(DATABASE_NAME, check_same_thread=False, isolation_level=None,
+                                cached_statements=128)
+        # Devolver filas como diccionarios para facilitar su uso en Flask
+        _conn.row_factory = sqlite3.Row
+    return _conn
+
+
+def get_history_version():
+    """
+    Devuelve un contador que cambia cada vez que se modifica el historial.
+    """
+    return _history_version
+
 
 def init_db():
     """
     Inicializa la base de datos y crea la tabla 'historial' si no existe.
     """
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-
-        # Crear la tabla si no existe
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS historial (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                fecha TEXT NOT NULL,
-                material TEXT,
-                objetos_detectados TEXT,
-                confianza REAL,
-                estado_envio TEXT NOT NULL
-            )
-        ''')
-
-        conn.commit()
+        with _lock:
+            conn = _get_conn()
+
+            # WAL: una sola sincronización a disco por commit en lugar de dos
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA temp_store=MEMORY')
+
+            # Crear la tabla si no existe
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS historial (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    fecha TEXT NOT NULL,
+                    material TEXT,
+                    objetos_detectados TEXT,
+                    confianza REAL,
+                    estado_envio TEXT NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_historial_fecha ON historial(fecha DESC)')
+
         print("Base de datos inicializada correctamente.")
     except sqlite3.Error as e:
         print(f"Error al inicializar la base de datos: {e}")
-    finally:
-        if conn:
-            conn.close()
+
+
+def _bump_history_version():
+    # Se llama con _lock adquirido
+    global _history_version
+    _history_version += 1
 
 
 def add_record(material, objetos, confianza, estado_envio):
@@ -49,29 +104,19 @@ def add_record(material, objetos, confianza, estado_envio):
         int: El ID del registro insertado, o None si hubo un error.
     """
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-
-        fecha_actual = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
         # Convertimos la lista de objetos a una cadena JSON para almacenarla
-        objetos_json = json.dumps(objetos)
+        objetos_json = orjson.dumps(objetos).decode()
 
-        cursor.execute('''
-            INSERT INTO historial (fecha, material, objetos_detectados, confianza, estado_envio)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (fecha_actual, material, objetos_json, confianza, estado_envio))
+        with _lock:
+            cursor = _get_conn().execute(_INSERT_SQL, (material, objetos_json, confianza, estado_envio))
 
-        conn.commit()
-        last_id = cursor.lastrowid
+            last_id = cursor.lastrowid
+            _bump_history_version()
         print(f"Registro añadido con ID: {last_id}")
         return last_id
     except sqlite3.Error as e:
         print(f"Error al añadir registro a la base de datos: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
 
 def update_record_status(record_id, nuevo_estado):
@@ -83,27 +128,19 @@ def update_record_status(record_id, nuevo_estado):
         nuevo_estado (str): El nuevo estado ('ENVIADO', 'ERROR').
     """
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            UPDATE historial
-            SET estado_envio = ?
-            WHERE id = ?
-        ''', (nuevo_estado, record_id))
+        with _lock:
+            _get_conn().execute(_UPDATE_SQL, (nuevo_estado, record_id))
 
-        conn.commit()
+            _bump_history_version()
         print(f"Estado del registro {record_id} actualizado a {nuevo_estado}.")
     except sqlite3.Error as e:
         print(f"Error al actualizar el estado del registro: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 
 def get_history(limit=20):
     """
-    Obtiene los últimos registros del historial.
+    Obtiene los últimos registros del historial. En lugar de la lista completa de
+    objetos detectados, cada registro trae solo 'objeto_principal' (ver get_record).
 
     Args:
         limit (int): El número máximo de registros a obtener.
@@ -112,22 +149,32 @@ def get_history(limit=20):
         list: Una lista de diccionarios, donde cada diccionario representa un registro.
     """
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        # Devolver filas como diccionarios para facilitar su uso en Flask
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT * FROM historial ORDER BY id DESC LIMIT ?', (limit,))
-
-        rows = cursor.fetchall()
+        with _lock:
+            rows = _get_conn().execute(_HISTORY_SQL, (limit,)).fetchall()
         # Convertir las filas a una lista de diccionarios estándar
         return [dict(row) for row in rows]
     except sqlite3.Error as e:
         print(f"Error al obtener el historial: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
+
+
+def get_record(record_id):
+    """
+    Obtiene un registro completo del historial, incluida la lista de objetos detectados.
+
+    Args:
+        record_id (int): El ID del registro.
+
+    Returns:
+        dict: El registro, o None si no existe o hubo un error.
+    """
+    try:
+        with _lock:
+            row = _get_conn().execute(_RECORD_SQL, (record_id,)).fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        print(f"Error al obtener el registro {record_id}: {e}")
+        return None
 
 
 # Para ejecutar la inicialización directamente desde la terminal
@@ -1,19 +1,97 @@
 import os
 import time
+import random
+import logging
 
 import requests
-import json
-import base64
+from requests.adapters import HTTPAdapter
+import orjson
 from PIL import Image
 import io
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-# Carga la clave de API desde una variable de entorno o un archivo de configuración
-API_KEY = os.environ.get("GEMINI_API_KEY")
-if not API_KEY:
+log = logging.getLogger(__name__)
+
+# Base64 con SIMD (pybase64/libbase64) opcional; sin él se usa el módulo base64 estándar,
+# que tiene la misma interfaz
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+# msgspec opcional: decodifica la respuesta de la API directamente a structs tipados,
+# sin construir los diccionarios intermedios
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Carga las claves de API desde variables de entorno. GEMINI_API_KEYS admite varias
+# claves separadas por comas para repartir la cuota; GEMINI_API_KEY sigue funcionando.
+API_KEYS = [k.strip() for k in os.environ.get("GEMINI_API_KEYS", os.environ.get("GEMINI_API_KEY", "")).split(",")
+            if k.strip()]
+if not API_KEYS:
     raise ValueError(
         "No se encontró la clave de API de Gemini. Asegúrate de configurar la variable de entorno GEMINI_API_KEY.")
 
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent?key={API_KEY}"
+# Modelos a probar en orden cuando uno agota su cuota (429)
+GEMINI_MODELS = [m.strip() for m in os.environ.get("GEMINI_MODELS", "gemini-1.5-flash-latest").split(",") if m.strip()]
+
+# Reintentos ante 429: espera exponencial con jitter, respetando Retry-After si viene
+MAX_RATE_LIMIT_ATTEMPTS = 3
+BACKOFF_BASE_SEC = 1.0
+BACKOFF_MAX_SEC = 30.0
+
+# Límite local de peticiones por minuto de cada combinación (clave, modelo); las que ya
+# gastaron su cupo se saltan sin enviar nada. 15 es el del nivel gratuito; 0 lo desactiva.
+GEMINI_RPM_LIMIT = int(os.environ.get("GEMINI_RPM_LIMIT", "15"))
+RATE_WINDOW_SEC = 60.0
+
+# Lado mayor máximo de la imagen enviada a Gemini; imágenes más grandes se reducen antes de subirlas
+MAX_IMAGE_SIDE = 1024
+SHRINK_JPEG_QUALITY = 85
+
+# Base de la API. Puede apuntar a un proxy que haga la rotación de claves del lado del servidor
+# (ej. LiteLLM: GEMINI_API_BASE=http://proxy:4000/gemini/v1beta con la clave del proxy en
+# GEMINI_API_KEY); así el bucle de rotación queda en una sola petición por clasificación.
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+# URL de cada modelo, armada una sola vez; la clave viaja aparte como parámetro de consulta
+_URLS = {model: f"{GEMINI_API_BASE}/models/{model}:generateContent" for model in GEMINI_MODELS}
+HEADERS = {"Content-Type": "application/json"}
+
+# Sesión HTTP compartida: reutiliza la conexión TCP/TLS con la API entre clasificaciones
+# en lugar de pagar un handshake completo en cada imagen
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+# Pool donde corren la reducción, el base64 y la llamada de red, fuera del hilo que captura
+_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="gemini")
+
+if msgspec is not None:
+    class _Part(msgspec.Struct):
+        text: str
+
+    class _Content(msgspec.Struct):
+        parts: list[_Part]
+
+    class _Candidate(msgspec.Struct):
+        content: _Content
+
+    class _GenerateContentResponse(msgspec.Struct):
+        candidates: list[_Candidate]
+
+    _response_decoder = msgspec.json.Decoder(_GenerateContentResponse)
+    _RESPONSE_ERRORS = (KeyError, IndexError, orjson.JSONDecodeError, msgspec.DecodeError)
+else:
+    _response_decoder = None
+    _RESPONSE_ERRORS = (KeyError, IndexError, orjson.JSONDecodeError)
+
+# Instantes de las peticiones de los últimos RATE_WINDOW_SEC, por (clave, modelo)
+_request_windows = {(k, m): deque() for k in API_KEYS for m in GEMINI_MODELS}
+_request_windows_lock = threading.Lock()
 
 PROMPT_TEXT = """
 Eres un asistente de clasificación de basura inteligente y amigable.
@@ -50,69 +128,251 @@ Siempre en tono amistoso y educativo.
 Ejemplo: "¡Genial! Detecté una botella de plástico. Recuerda que puedes reciclarla para ayudar al planeta."
 """
 
+# Todo el cuerpo de la petición es fijo salvo el base64 de la imagen: se serializa una vez al
+# importar el módulo y cada llamada solo concatena bytes. Pide JSON puro en la respuesta para
+# que Gemini no la envuelva en un bloque ```json.
+_BODY_PREFIX = (b'{"contents":[{"parts":[{"text":' + orjson.dumps(PROMPT_TEXT)
+                + b'},{"inline_data":{"mime_type":"image/jpeg","data":"')
+_BODY_SUFFIX = b'"}}]}],"generationConfig":{"response_mime_type":"application/json"}}'
 
-def classify_image(image_bytes, retries=1):
-    print("Enviando imagen a Gemini para clasificación...")
-    base64_image = base64.b64encode(image_bytes).decode('utf-8')
-
-    payload = {
-        "contents": [
-            {
-                "parts": [
-                    {"text": PROMPT_TEXT},
-                    {
-                        "inline_data": {
-                            "mime_type": "image/jpeg",
-                            "data": base64_image
-                        }
-                    }
-                ]
-            }
-        ]
-    }
 
-    headers = {"Content-Type": "application/json"}
+def _backoff_delay(attempt, retry_after=None):
+    """
+    Calcula la espera antes del siguiente reintento.
 
-    for attempt in range(retries + 1):
+    Args:
+        attempt (int): Número de reintento, empezando en 0.
+        retry_after (str, optional): Valor de la cabecera Retry-After, en segundos.
+
+    Returns:
+        float: Segundos a esperar, como máximo BACKOFF_MAX_SEC.
+    """
+    if retry_after:
         try:
-            # <<< LÍNEA MODIFICADA >>>
-            # Se ha añadido un timeout de 30 segundos. Si no hay respuesta, fallará.
-            response = requests.post(GEMINI_API_URL, headers=headers, json=payload, timeout=30)
-            response.raise_for_status()  # Lanza un error si la respuesta es 4xx o 5xx
+            return min(BACKOFF_MAX_SEC, float(retry_after))
+        except ValueError:
+            pass  # Retry-After en formato fecha: se usa la espera exponencial
+    return min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * 2 ** attempt * (1 + random.uniform(0, 0.5)))
+
+
+def _shrink(image_bytes, max_side=MAX_IMAGE_SIDE, quality=SHRINK_JPEG_QUALITY):
+    """
+    Reduce la imagen para que su lado mayor no supere max_side y la recodifica como JPEG.
+
+    Si la imagen ya es suficientemente pequeña se devuelven los mismos bytes sin
+    decodificarla (Image.open solo lee la cabecera).
+
+    Args:
+        image_bytes (bytes): Imagen original.
+        max_side (int): Lado mayor máximo en píxeles.
+        quality (int): Calidad JPEG de la imagen reducida.
+
+    Returns:
+        bytes: La imagen lista para enviar.
+    """
+    im = Image.open(io.BytesIO(image_bytes))
+    if max(im.size) <= max_side:
+        return image_bytes
+    # Con JPEG, draft() decodifica directamente a una escala reducida, mucho más barato
+    im.draft("RGB", (max_side, max_side))
+    im.thumbnail((max_side, max_side), Image.LANCZOS)
+    out = io.BytesIO()
+    im.convert("RGB").save(out, "JPEG", quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def _pruned_window(api_key, model_name, now):
+    """Devuelve la ventana de la combinación sin las peticiones vencidas. Llamar con _request_windows_lock tomado."""
+    window = _request_windows[(api_key, model_name)]
+    while window and now - window[0] > RATE_WINDOW_SEC:
+        window.popleft()
+    return window
+
+
+def _has_budget(api_key, model_name):
+    """Indica si la combinación aún tiene cupo en la ventana, sin registrar ninguna petición."""
+    if GEMINI_RPM_LIMIT <= 0:
+        return True
+    with _request_windows_lock:
+        return len(_pruned_window(api_key, model_name, time.monotonic())) < GEMINI_RPM_LIMIT
+
+
+def _admit(api_key, model_name):
+    """Registra una petición si la combinación aún tiene cupo en la ventana; devuelve False si no lo tiene."""
+    if GEMINI_RPM_LIMIT <= 0:
+        return True
+    now = time.monotonic()
+    with _request_windows_lock:
+        window = _pruned_window(api_key, model_name, now)
+        if len(window) >= GEMINI_RPM_LIMIT:
+            return False
+        window.append(now)
+        return True
 
-            response_json = response.json()
 
-            # Extraer el contenido JSON del texto
-            json_str = response_json['candidates'][0]['content']['parts'][0]['text']
-            # Limpiar el string en caso de que venga con formato markdown
-            if json_str.startswith("```json"):
-                json_str = json_str.strip("```json\n").strip("`")
+def _mark_exhausted(api_key, model_name):
+    """Tras agotar los reintentos por 429, llena la ventana para no volver a probar la combinación hasta que se libere."""
+    if GEMINI_RPM_LIMIT <= 0:
+        return
+    now = time.monotonic()
+    with _request_windows_lock:
+        window = _request_windows[(api_key, model_name)]
+        window.extend([now] * (GEMINI_RPM_LIMIT - len(window)))
 
-            return json.loads(json_str)
+
+class _RateLimited(Exception):
+    """La API respondió 429; guarda el valor de Retry-After si vino en la respuesta."""
+
+    def __init__(self, retry_after=None):
+        super().__init__("429 Too Many Requests")
+        self.retry_after = retry_after
+
+
+def _build_body(image_bytes):
+    """Arma el cuerpo JSON de la petición con el prompt y la imagen en base64."""
+    # El base64 solo usa caracteres que no necesitan escape en JSON, así que se pega tal cual
+    return _BODY_PREFIX + base64.b64encode(image_bytes) + _BODY_SUFFIX
+
+
+def _response_text(content):
+    """Extrae el texto de la primera parte del primer candidato de la respuesta de generateContent."""
+    if _response_decoder is not None:
+        return _response_decoder.decode(content).candidates[0].content.parts[0].text
+    return orjson.loads(content)['candidates'][0]['content']['parts'][0]['text']
+
+
+def _post_once(session, url, api_key, body, timeout):
+    """
+    Hace una sola petición a generateContent y extrae la clasificación.
+
+    Args:
+        session (requests.Session): Sesión HTTP a usar.
+        url (str): URL del modelo.
+        api_key (str): Clave de API a usar.
+        body (bytes): Cuerpo JSON ya serializado.
+        timeout (float): Segundos máximos de espera.
+
+    Returns:
+        dict: La clasificación devuelta por el modelo.
+
+    Raises:
+        _RateLimited: Si la API respondió 429.
+        requests.exceptions.RequestException: Errores de red o respuestas 4xx/5xx.
+        _RESPONSE_ERRORS: Si la respuesta no tiene el formato esperado.
+    """
+    response = session.post(url, params={"key": api_key}, headers=HEADERS, data=body, timeout=timeout)
+    if response.status_code == 429:
+        raise _RateLimited(response.headers.get("Retry-After"))
+    response.raise_for_status()  # Lanza un error si la respuesta es 4xx o 5xx
+
+    # Extraer el contenido JSON del texto
+    json_str = _response_text(response.content)
+    # Quedarse solo con el objeto JSON por si aún viene envuelto en markdown u otro texto
+    start = json_str.find("{")
+    end = json_str.rfind("}") + 1
+    return orjson.loads(json_str[start:end])
+
+
+def _post_with_retries(api_key, model_name, body, timeout, retries):
+    """
+    Envía la petición a una combinación (clave, modelo), reintentando errores transitorios.
+
+    Returns:
+        dict | None: La clasificación o un diccionario de error; None si la cuota de
+        esta combinación está agotada y hay que pasar a la siguiente.
+    """
+    url = _URLS[model_name]
+    attempt = 0
+    rate_limited = 0
+    while True:
+        if not _admit(api_key, model_name):
+            log.info("Sin cupo local para el modelo %s en esta clave. Probando la siguiente combinación...", model_name)
+            return None
+        try:
+            return _post_once(SESSION, url, api_key, body, timeout)
+
+        except _RateLimited as e:
+            if rate_limited + 1 >= MAX_RATE_LIMIT_ATTEMPTS:
+                log.warning("Cuota agotada para el modelo %s. Probando la siguiente combinación...", model_name)
+                _mark_exhausted(api_key, model_name)
+                return None
+            if not _has_budget(api_key, model_name):
+                # _admit rechazaría el reintento de todos modos: mejor rotar ya que dormir antes
+                log.info("Sin cupo local para el modelo %s en esta clave. Probando la siguiente combinación...", model_name)
+                return None
+            delay = _backoff_delay(rate_limited, e.retry_after)
+            rate_limited += 1
+            log.info("Límite de uso alcanzado (429). Reintentando en %.1f s...", delay)
+            time.sleep(delay)
 
         except requests.exceptions.Timeout:
-            print(f"Error: La solicitud a Gemini superó el tiempo de espera de 30 segundos.")
+            log.warning("La solicitud a Gemini superó el tiempo de espera de %s segundos.", timeout)
             if attempt < retries:
-                print("Reintentando...")
+                log.info("Reintentando...")
+                attempt += 1
             else:
                 return {"error": "Timeout", "message": "La API no respondió a tiempo."}
 
         except requests.exceptions.RequestException as e:
-            print(f"Error inesperado al contactar con la API de Gemini: {e}")
+            log.warning("Error inesperado al contactar con la API de Gemini: %s", e)
             if attempt < retries:
-                print(f"Intento {attempt + 1} de clasificación falló. Reintentando...")
-                time.sleep(2)  # Espera 2 segundos antes de reintentar
+                log.info("Intento %d de clasificación falló. Reintentando...", attempt + 1)
+                time.sleep(_backoff_delay(attempt))
+                attempt += 1
             else:
                 return {"error": "API Connection Error", "message": str(e)}
-        except (KeyError, IndexError, json.JSONDecodeError) as e:
-            print(f"Error al procesar la respuesta de Gemini: {e}")
+
+        except _RESPONSE_ERRORS as e:
+            log.error("Error al procesar la respuesta de Gemini: %s", e)
             return {"error": "Invalid Response", "message": "La respuesta de la API no tuvo el formato esperado."}
 
-    return None
+
+def _classify(image_bytes, timeout, shrink, retries):
+    """Reduce, serializa y envía la imagen, rotando claves y modelos. Corre dentro de _POOL."""
+    log.debug("Enviando imagen a Gemini para clasificación...")
+    if shrink:
+        image_bytes = _shrink(image_bytes)
+    # El cuerpo se serializa una sola vez y se reutiliza en todos los reintentos y rotaciones
+    body = _build_body(image_bytes)
+
+    # Se prueban las combinaciones (clave, modelo) en orden; tras MAX_RATE_LIMIT_ATTEMPTS
+    # respuestas 429 seguidas se pasa a la siguiente
+    for api_key in API_KEYS:
+        for model_name in GEMINI_MODELS:
+            result = _post_with_retries(api_key, model_name, body, timeout, retries)
+            if result is not None:
+                return result
+
+    return {"error": "Overloaded", "message": "Todas las claves y modelos alcanzaron su límite de uso."}
+
+
+def submit_classification(image_bytes, *, timeout=30, shrink=True, retries=1):
+    """
+    Encola la clasificación de una imagen y devuelve de inmediato.
+
+    Args:
+        image_bytes (bytes): Imagen JPEG a clasificar.
+        timeout (float): Segundos máximos de espera por petición.
+        shrink (bool): Si es True, reduce las imágenes mayores que MAX_IMAGE_SIDE antes de enviarlas.
+        retries (int): Reintentos ante timeouts o errores de conexión, por combinación (clave, modelo).
+
+    Returns:
+        concurrent.futures.Future: Se resuelve con la clasificación del modelo, o con un
+        diccionario con "error" y "message".
+    """
+    return _POOL.submit(_classify, image_bytes, timeout, shrink, retries)
+
+
+def classify_image(image_bytes, *, timeout=30, shrink=True, retries=1):
+    """Versión bloqueante de submit_classification: espera y devuelve la clasificación."""
+    return submit_classification(image_bytes, timeout=timeout, shrink=shrink, retries=retries).result()
 
 
 # Ejemplo de uso (para pruebas)
 if __name__ == '__main__':
+    # DEBUG solo para este módulo: en el logger raíz, urllib3 registraría las URLs con ?key=
+    logging.basicConfig()
+    log.setLevel(logging.DEBUG)
     # Carga una imagen de ejemplo llamada 'test_image.jpg'
     try:
         with open("test_image.jpg", "rb") as f: